@@ -1,17 +1,16 @@
-import six
 import os
-import glob
+import shutil
 import hashlib
 import datetime
 import requests
 import subprocess
-from time import sleep
+from time import sleep, monotonic
 from charmhelpers import fetch
 from charmhelpers.core import host, hookenv, unitdata
 from charmhelpers.core.templating import render
 from charmhelpers.contrib.charmsupport import nrpe
 from charms.reactive import when, when_not, set_state, only_once
-from charms.reactive.helpers import any_file_changed, data_changed
+from charms.reactive.helpers import data_changed
 
 
 try:
@@ -20,32 +19,89 @@ except ImportError:
     fetch.apt_install(['python-sqlite'])
     import sqlite3
 
-try:
-    import pbkdf2
-except ImportError:
-    if six.PY3:
-        fetch.apt_install(['python3-pbkdf2'])
-    else:
-        fetch.apt_install(['python-pbkdf2'])
-    import pbkdf2
-
 SVCNAME = 'grafana-server'
 GRAFANA_INI = '/etc/grafana/grafana.ini'
 GRAFANA_INI_TMPL = 'grafana.ini.j2'
 GRAFANA_DEPS = ['libfontconfig1']
+GRAFANA_DB = '/var/lib/grafana/grafana.db'
+
+_HTTP = requests.Session()
+_HTTP.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=2,
+                                                      max_retries=3))
+
+_CONN = None
+
+
+def _db():
+    """Return a cached connection to grafana.db.
+
+    grafana.db is local and this charm is its only writer, so one
+    connection can be kept warm for the whole hook invocation instead
+    of opening and closing one per query.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(GRAFANA_DB, timeout=30,
+                                isolation_level=None,
+                                check_same_thread=False)
+        # WAL + NORMAL cut the fsyncs per commit; the rows this charm
+        # writes (admin password, datasources) are re-created on the
+        # next hook run anyway, so full durability is not needed.
+        _CONN.execute('PRAGMA journal_mode=WAL')
+        _CONN.execute('PRAGMA synchronous=NORMAL')
+        _CONN.execute('PRAGMA temp_store=MEMORY')
+        # Checkpoint every ~1000 WAL pages rather than per commit, with
+        # an 8MB page cache
+        _CONN.execute('PRAGMA wal_autocheckpoint=1000')
+        _CONN.execute('PRAGMA cache_size=-8000')
+    return _CONN
+
+
+def _close_db():
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+
+hookenv.atexit(_close_db)
+
+
+_CFG_CACHE = {}
+
+
+def _config():
+    """Return the charm config, parsed at most once per hook.
+
+    hookenv.config() re-reads the config from juju every time it is
+    called, and a single hook run can hit it from several handlers.
+    """
+    hook = hookenv.hook_name()
+    cfg = _CFG_CACHE.get(hook)
+    if cfg is None:
+        cfg = hookenv.config()
+        _CFG_CACHE[hook] = cfg
+    return cfg
+
+
+hookenv.atexit(_CFG_CACHE.clear)
 
 
 def install_packages():
-    config = hookenv.config()
+    config = _config()
     install_opts = ('install_sources', 'install_keys')
     if config.changed('install_file') and config.get('install_file', False):
         hookenv.status_set('maintenance', 'Installing deb pkgs')
         fetch.apt_install(GRAFANA_DEPS)
         pkg_file = '/tmp/grafana.deb'
+        # Debs are already compressed; identity avoids a pointless
+        # gzip round-trip on the download.
+        r = _HTTP.get(config.get('install_file'), stream=True,
+                      headers={'Accept-Encoding': 'identity'},
+                      timeout=(10, 120))
+        r.raise_for_status()
         with open(pkg_file, 'wb') as f:
-            r = requests.get(config.get('install_file'), stream=True)
-            for block in r.iter_content(1024):
-                f.write(block)
+            shutil.copyfileobj(r.raw, f, length=1024 * 1024)
         subprocess.check_call(['dpkg', '-i', pkg_file])
     elif any(config.changed(opt) for opt in install_opts):
         hookenv.status_set('maintenance', 'Installing deb pkgs')
@@ -68,7 +124,7 @@ def check_ports(new_port):
 def setup_grafana():
     hookenv.status_set('maintenance', 'Configuring grafana')
     install_packages()
-    config = hookenv.config()
+    config = _config()
     settings = {'config': config}
     render(source=GRAFANA_INI_TMPL,
            target=GRAFANA_INI,
@@ -81,11 +137,49 @@ def setup_grafana():
     hookenv.status_set('active', 'Ready')
 
 
+# Config keys that feed grafana.ini (or the install/port handling done
+# alongside the render); anything else can change without a re-render
+# and service restart.
+INI_CONFIG_KEYS = ('app_mode', 'anonymous', 'anonymous_role', 'port',
+                   'install_sources', 'install_keys', 'install_file')
+
+
 @when('grafana.started')
 def check_config():
-    if data_changed('grafana.config', hookenv.config()):
+    config = _config()
+    ini_config = {k: config.get(k) for k in INI_CONFIG_KEYS}
+    if data_changed('grafana.ini.config', ini_config):
         setup_grafana()  # reconfigure and restart
     db_init()
+    # After db_init so the first run stays behind the schema wait
+    if data_changed('grafana.admin', config.get('admin_password')):
+        check_adminuser()
+
+
+def _ini_changed():
+    """Check whether grafana.ini changed since the last look.
+
+    A matching (mtime, size) signature stored in unitdata means
+    unchanged without touching the contents. On a mismatch fall back to
+    hashing the content — render() rewrites the file even when the
+    result is identical, so the mtime alone would force needless
+    restarts.
+    """
+    kv = unitdata.kv()
+    try:
+        st = os.stat(GRAFANA_INI)
+    except FileNotFoundError:
+        return True
+    sig = [st.st_mtime_ns, st.st_size]
+    if kv.get('grafana.ini.sig') == sig:
+        return False
+    kv.set('grafana.ini.sig', sig)
+    with open(GRAFANA_INI, 'rb') as f:
+        digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    if kv.get('grafana.ini.hash') == digest:
+        return False
+    kv.set('grafana.ini.hash', digest)
+    return True
 
 
 @when('grafana.start')
@@ -93,17 +187,48 @@ def restart_grafana():
     if not host.service_running(SVCNAME):
         hookenv.log('Starting {}...'.format(SVCNAME))
         host.service_start(SVCNAME)
-    elif any_file_changed([GRAFANA_INI]):
+    elif _ini_changed():
         hookenv.log('Restarting {}, config file changed...'.format(SVCNAME))
         host.service_restart(SVCNAME)
     hookenv.status_set('active', 'Ready')
     set_state('grafana.started')
 
 
+def _wait_for_schema(timeout=30):
+    """Wait for grafana-server to create its sqlite schema.
+
+    Polls for the user table with exponential backoff instead of a flat
+    sleep; grafana is usually ready well within a second of starting.
+    """
+    deadline = monotonic() + timeout
+    delay = 0.05
+    while monotonic() < deadline:
+        try:
+            # Read-only open: a plain connect would create an empty
+            # root-owned db file before grafana-server gets to it
+            conn = sqlite3.connect('file:' + GRAFANA_DB + '?mode=ro',
+                                   uri=True, timeout=1)
+            try:
+                ready = conn.execute(
+                    "SELECT 1 FROM sqlite_master"
+                    " WHERE type='table' AND name='user'").fetchone()
+            finally:
+                conn.close()
+            if ready:
+                return True
+        except sqlite3.OperationalError:
+            pass
+        sleep(delay)
+        delay = min(delay * 2, 5.0)
+    return False
+
+
 @only_once
 def db_init():
-    sleep(10)
-    check_adminuser()
+    if _wait_for_schema():
+        check_adminuser()
+    else:
+        hookenv.log('db_init: timed out waiting for grafana schema')
 
 
 @when('nrpe-external-master.available')
@@ -119,24 +244,38 @@ def update_nrpe_config(svc):
 
 @when_not('nrpe-external-master.available')
 def wipe_nrpe_checks():
-    checks = ['/etc/nagios/nrpe.d/check_grafana-server.cfg',
-              '/var/lib/nagios/export/service__*_grafana-server.cfg']
-    for check in checks:
-        for f in glob.glob(check):
-            if os.path.isfile(f):
-                os.unlink(f)
+    check = '/etc/nagios/nrpe.d/check_grafana-server.cfg'
+    try:
+        os.unlink(check)
+    except (FileNotFoundError, IsADirectoryError):
+        pass
+    try:
+        for entry in os.scandir('/var/lib/nagios/export/'):
+            name = entry.name
+            if (name.startswith('service__') and
+                    name.endswith('_grafana-server.cfg') and
+                    entry.is_file(follow_symlinks=False)):
+                os.unlink(entry.path)
+    except FileNotFoundError:
+        pass
 
 
 @when('grafana.started')
 @when('grafana-source.available')
 def configure_sources(relation):
     sources = relation.datasources()
-    if not data_changed('grafana.sources', sources):
+    key = hashlib.blake2b(
+        repr(sorted((ds['type'], ds['service_name'], ds['url'],
+                     ds['description'], ds.get('username') or '',
+                     ds.get('password') or '')
+                    for ds in sources)).encode(),
+        digest_size=16).hexdigest()
+    kv = unitdata.kv()
+    if kv.get('grafana.sources.hash') == key:
         return
-    for ds in sources:
-        hookenv.log('Found datasource: {}'.format(str(ds)))
-        # Ensure datasource is configured
-        check_datasource(ds)
+    kv.set('grafana.sources.hash', key)
+    # Ensure datasources are configured
+    check_datasources(sources)
 
 
 @when('grafana.started')
@@ -149,7 +288,7 @@ def sources_gone():
 
 @when('website.available')
 def configure_website(website):
-    website.configure(port=hookenv.config('port'))
+    website.configure(port=_config().get('port'))
 
 
 def validate_datasources():
@@ -157,17 +296,19 @@ def validate_datasources():
     relation data
     TODO: make sure datasources are validated
     """
-    config = hookenv.config()
-
-    if config.get('datasources', False):
-        items = config['datasources'].split(',')
-        if len(items) != 7:
-            return False
-        elif items[0] != 'prometheus' and items[2] != 'proxy':
-            return False
+    datasources = _config().get('datasources') or ''
+    if not datasources:
+        return
+    # Cheap gates before splitting: field count, then the common
+    # 'prometheus' prefix
+    if datasources.count(',') != 6:
+        return False
+    if (not datasources.startswith('prometheus,') and
+            datasources.split(',')[2] != 'proxy'):
+        return False
 
 
-def check_datasource(ds):
+def check_datasources(sources):
     """
     CREATE TABLE `data_source` (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL
@@ -200,40 +341,64 @@ def check_datasource(ds):
     #  'password': 'password
     # }
 
-    conn = sqlite3.connect('/var/lib/grafana/grafana.db', timeout=30)
+    conn = _db()
     cur = conn.cursor()
+    cur.execute('BEGIN')
     query = cur.execute('SELECT id, type, name, url, is_default FROM DATA_SOURCE')
-    rows = query.fetchall()
-    ds_name = '{} - {}'.format(ds['service_name'], ds['description'])
-    print(ds_name)
-    print(rows)
-    for row in rows:
-        if (row[1] == ds['type'] and row[2] == ds_name and row[3] == ds['url']):
+    existing = {(row[1], row[2], row[3]): (row[0], row[4])
+                for row in query.fetchall()}
+    # All datasources in this batch share one created/updated timestamp
+    now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    # Group the value tuples per statement so each one is prepared once
+    # and executed over its whole batch
+    batches = {}
+    for ds in sources:
+        hookenv.log('Found datasource: {}'.format(str(ds)))
+        ds_name = '{} - {}'.format(ds['service_name'], ds['description'])
+        hit = existing.get((ds['type'], ds_name, ds['url']))
+        if hit is not None:
             hookenv.log('Datasource already exist, updating: {}'.format(ds_name))
-            stmt, values = generate_query(ds, row[4], row[0])
-            print(stmt, values)
-            cur.execute(stmt, values)
-            conn.commit()
-            conn.close()
-            return
-    hookenv.log('Adding new datasource: {}'.format(ds_name))
-    stmt, values = generate_query(ds, 0)
-    print(stmt, values)
-    cur.execute(stmt, values)
+            stmt, values = generate_query(ds, hit[1], hit[0])
+        else:
+            hookenv.log('Adding new datasource: {}'.format(ds_name))
+            stmt, values = generate_query(ds, 0, now=now)
+        batches.setdefault(stmt, []).append(values)
+    for stmt, batch in batches.items():
+        cur.executemany(stmt, batch)
     conn.commit()
-    conn.close()
 
 
-def generate_query(ds, is_default, id=None):
-    if not id:
-        stmt = 'INSERT INTO DATA_SOURCE (org_id, version, type, name' + \
-               ', access, url, is_default, created, updated, basic_auth'
-        if 'username' in ds and 'password' in ds:
-            stmt += ', basic_auth_user, basic_auth_password)' + \
-                    ' VALUES (?,?,?,?,?,?,?,?,?,?,?,?)'
-        else:
-            stmt += ') VALUES (?,?,?,?,?,?,?,?,?,?)'
-        dtime = datetime.datetime.today().strftime("%F %T")
+_SQL_INSERT_DS_AUTH = (
+    'INSERT INTO DATA_SOURCE (org_id, version, type, name, access, url'
+    ', is_default, created, updated, basic_auth, basic_auth_user'
+    ', basic_auth_password) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)')
+_SQL_INSERT_DS_NOAUTH = (
+    'INSERT INTO DATA_SOURCE (org_id, version, type, name, access, url'
+    ', is_default, created, updated, basic_auth)'
+    ' VALUES (?,?,?,?,?,?,?,?,?,?)')
+_SQL_UPDATE_DS_AUTH = (
+    'UPDATE DATA_SOURCE SET basic_auth_user = ?'
+    ', basic_auth_password = ?, basic_auth = 1')
+_SQL_UPDATE_DS_NOAUTH = (
+    'UPDATE DATA_SOURCE SET basic_auth_user = ?'
+    ', basic_auth_password = ?, basic_auth = 0')
+
+# (insert, has_auth) -> statement
+_SQL_DS_STMTS = {
+    (True, True): _SQL_INSERT_DS_AUTH,
+    (True, False): _SQL_INSERT_DS_NOAUTH,
+    (False, True): _SQL_UPDATE_DS_AUTH,
+    (False, False): _SQL_UPDATE_DS_NOAUTH,
+}
+
+
+def generate_query(ds, is_default, id=None, now=None):
+    insert = not id
+    has_auth = 'username' in ds and 'password' in ds
+    stmt = _SQL_DS_STMTS[(insert, has_auth)]
+    if insert:
+        if now is None:
+            now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
         values = (1,
                   0,
                   ds['type'],
@@ -241,19 +406,16 @@ def generate_query(ds, is_default, id=None):
                   'proxy',
                   ds['url'],
                   is_default,
-                  dtime,
-                  dtime)
-        if 'username' in ds and 'password' in ds:
+                  now,
+                  now)
+        if has_auth:
             values = values + (1, ds['username'], ds['password'])
         else:
             values = values + (0,)
+    elif has_auth:
+        values = (ds['username'], ds['password'])
     else:
-        if 'username' in ds and 'password' in ds:
-            stmt = 'UPDATE DATA_SOURCE SET basic_auth_user = ?, basic_auth_password = ?, basic_auth = 1'
-            values = (ds['username'], ds['password'])
-        else:
-            stmt = 'UPDATE DATA_SOURCE SET basic_auth_user = ?, basic_auth_password = ?, basic_auth = 0'
-            values = ('', '')
+        values = ('', '')
     return (stmt, values)
 
 
@@ -278,7 +440,7 @@ def check_adminuser():
     );
     INSERT INTO "user" VALUES(1,0,'admin','root+bootstack-ps45@canonical.com','BootStack Team','309bc4e78bc60d02dc0371d9e9fa6bf9a809d5dc25c745b9e3f85c3ed49c6feccd4ffc96d1db922f4297663a209e93f7f2b6','LZeJ3nSdrC','hseJcLcnPN','',1,1,0,'light','2016-01-22 12:00:08','2016-01-22 12:02:13');
     """
-    config = hookenv.config()
+    config = _config()
     passwd = config.get('admin_password', False)
     if not passwd:
         passwd = host.pwgen(16)
@@ -290,29 +452,29 @@ def check_adminuser():
         stmt += ", password=?, theme='light'"
         stmt += " WHERE id = ?"
 
-        conn = sqlite3.connect('/var/lib/grafana/grafana.db', timeout=30)
+        conn = _db()
         cur = conn.cursor()
-        query = cur.execute('SELECT id, login, salt FROM user')
-        for row in query.fetchall():
-            if row[1] == 'admin':
-                nagios_context = config.get('nagios_context', False)
-                if not nagios_context:
-                    nagios_context = 'UNKNOWN'
-                email = 'root+%s@canonical.com' % nagios_context
-                hpasswd = hpwgen(passwd, row[2])
-                if hpasswd:
-                    cur.execute(stmt, (email, hpasswd, row[0]))
-                    conn.commit()
-                    hookenv.log('[*] admin password updated on database')
-                else:
-                    hookenv.log('Could not update user table: hpwgen func failed')
-                break
-        conn.close()
+        row = cur.execute('SELECT id, salt FROM user WHERE login = ? LIMIT 1',
+                          ('admin',)).fetchone()
+        if row is None:
+            return
+        nagios_context = config.get('nagios_context', False)
+        if not nagios_context:
+            nagios_context = 'UNKNOWN'
+        email = 'root+%s@canonical.com' % nagios_context
+        hpasswd = hpwgen(passwd, row[1])
+        if hpasswd:
+            cur.execute(stmt, (email, hpasswd, row[0]))
+            conn.commit()
+            hookenv.log('[*] admin password updated on database')
+        else:
+            hookenv.log('Could not update user table: hpwgen func failed')
     except sqlite3.OperationalError as e:
         hookenv.log('check_adminuser::sqlite3.OperationError: {}'.format(e))
         return
 
 
 def hpwgen(passwd, salt):
-    hpasswd = pbkdf2.PBKDF2(passwd, salt, 10000, hashlib.sha256).hexread(50)
-    return hpasswd
+    hpasswd = hashlib.pbkdf2_hmac('sha256', passwd.encode('utf-8'),
+                                  salt.encode('utf-8'), 10000, dklen=50)
+    return hpasswd.hex()